@@ -1,10 +1,15 @@
 import argparse
-import collections
-import json
+import functools
 import logging
-import requests
+import os
+import orjson
+import sqlite3
 import sys
-import validators
+import threading
+import time
+import urllib3
+from concurrent.futures import Future, ThreadPoolExecutor
+from urllib.parse import urlsplit
 
 
 # Declare constants
@@ -12,48 +17,209 @@ POST_LIST_URL = "https://hacker-news.firebaseio.com/v0/topstories.json"
 POST_URL = "https://hacker-news.firebaseio.com/v0/item/%d.json"
 TEXT_POST_URL = "https://news.ycombinator.com/item?id=%d"
 
-# Set up logging for debugging
-logging.basicConfig(filename='hackernews.log',
-                    filemode='a',
-                    format=('%(asctime)s,%(msecs)d %(name)s %(levelname)s '
-                            '%(message)s'),
-                    datefmt='%H:%M:%S',
-                    level=logging.DEBUG)
-
-
-class JSONHandler():
-    """Class handling generic JSON methods."""
-
-    def get_json_from_url(self, url):
-        """Retrieve JSON content from given URL."""
-        logging.debug("Retrieving JSON from %s" % url)
+# Algolia's Hacker News search API returns many posts in one response.
+# Matches stories whose ID is in the given comma separated list of tags.
+BATCH_POST_URL = ("https://hn.algolia.com/api/v1/search"
+                  "?tags=story,(%s)&hitsPerPage=%d")
+
+# Maximum number of post JSONs to fetch concurrently.
+MAX_WORKERS = 32
+
+# Seconds to wait to connect and between bytes read for each HTTP attempt.
+# A connection that stalls is abandoned (and retried per the policy below)
+# rather than hanging the run.  This isn't a deadline on the whole response:
+# a server that keeps trickling bytes is never cut off.
+CONNECT_TIMEOUT = 3.05
+READ_TIMEOUT = 10
+
+# On-disk cache of retrieved JSON, and how long (in seconds) entries are
+# fresh.  The post list changes often; individual posts change slowly.
+CACHE_FILE = "hackernews_cache.sqlite"
+POST_LIST_MAX_AGE = 60
+POST_MAX_AGE = 600
+
+# Logging is discarded unless handlers are added, as configure_logging does
+# for the command line tool.
+logger = logging.getLogger('hackernews')
+logger.addHandler(logging.NullHandler())
+
+# Share one pool manager so TCP connections and TLS sessions are reused
+# across requests.  Pool size matches the number of concurrent fetches.
+# Ignore Retry-After headers, which could otherwise make us sleep for as long
+# as the server asks.
+_HTTP = urllib3.PoolManager(
+    num_pools=4,
+    maxsize=MAX_WORKERS,
+    timeout=urllib3.Timeout(connect=CONNECT_TIMEOUT, read=READ_TIMEOUT),
+    retries=urllib3.Retry(total=3, backoff_factor=0.2,
+                          status_forcelist=[429, 500, 502, 503, 504],
+                          respect_retry_after_header=False))
+
+
+class JSONCache():
+    """On-disk cache of JSON keyed by URL.  Safe to share between threads.
+
+    The database file is only opened on first use.  Entries older than the
+    longest freshness period are deleted periodically.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.conn = None
+        self.opened = False
+        self.pruned_at = 0
+
+    def open(self):
+        """Open the database if not yet done.  Caller must hold the lock."""
+        if self.opened:
+            return self.conn
+        self.opened = True
 
         try:
-            r = requests.get(url)
-        except:
-            logging.exception("Error GETting from URL %s" % url)
+            self.conn = sqlite3.connect(self.filename, check_same_thread=False)
+            # This is only a cache, so don't wait for the disk on each write.
+            self.conn.execute("PRAGMA synchronous = OFF")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS json_cache ("
+                              "url TEXT PRIMARY KEY, "
+                              "fetched_at REAL NOT NULL, "
+                              "json_blob TEXT NOT NULL)")
+            self.prune()
+        except sqlite3.Error:
+            # Carry on without a cache rather than fail the run.
+            logger.exception("Error opening cache %s", self.filename)
+            self.conn = None
+        return self.conn
+
+    def prune(self):
+        """Delete entries too old to be used.  Caller must hold the lock."""
+        now = time.time()
+        with self.conn:
+            self.conn.execute("DELETE FROM json_cache WHERE fetched_at < ?",
+                              (now - POST_MAX_AGE,))
+        self.pruned_at = now
+
+    def get(self, url, max_age):
+        """Return cached JSON for url if fetched within max_age seconds."""
+        try:
+            with self.lock:
+                if self.open() is None:
+                    return None
+                row = self.conn.execute(
+                    "SELECT fetched_at, json_blob FROM json_cache "
+                    "WHERE url = ?", (url,)).fetchone()
+        except sqlite3.Error:
+            logger.exception("Error reading cache for URL %s", url)
             return None
 
-        if (r.status_code != 200):
-            logging.error("Error retrieving URL. Status code: %d." %
-                          r.status_code)
+        if row is None or row[0] < time.time() - max_age:
             return None
+        return orjson.loads(row[1])
 
-        result = None
+    def put(self, url, result):
+        """Store JSON for url."""
         try:
-            result = r.json()
-        except (ValueError):
-            logging.error("No JSON found in response")
-
-        logging.debug("Retrieved JSON: %s" % result)
-        return result
+            with self.lock:
+                if self.open() is None:
+                    return
+                with self.conn:
+                    self.conn.execute(
+                        "INSERT OR REPLACE INTO json_cache VALUES (?, ?, ?)",
+                        (url, time.time(), orjson.dumps(result)))
+
+                # Long running processes would otherwise keep every entry.
+                if self.pruned_at < time.time() - POST_MAX_AGE:
+                    self.prune()
+        except sqlite3.Error:
+            logger.exception("Error writing cache for URL %s", url)
+
+
+_CACHE = JSONCache(CACHE_FILE)
+
+
+def get_json_from_url(url, max_age=0):
+    """Retrieve JSON content from given URL.
+
+    If max_age is non-zero, a cached copy no older than max_age seconds
+    is returned without going to the network.
+    """
+    if max_age:
+        result = _CACHE.get(url, max_age)
+        if result is not None:
+            logger.debug("Retrieved cached JSON for %s", url)
+            return result
+
+    logger.debug("Retrieving JSON from %s", url)
+
+    try:
+        r = _HTTP.request("GET", url)
+    except:
+        logger.exception("Error GETting from URL %s", url)
+        return None
+
+    if (r.status != 200):
+        logger.error("Error retrieving URL. Status code: %d.", r.status)
+        return None
+
+    result = None
+    try:
+        result = orjson.loads(r.data)
+    except (orjson.JSONDecodeError):
+        logger.error("No JSON found in response")
+
+    logger.debug("Retrieved JSON: %s", result)
+    if result is not None:
+        _CACHE.put(url, result)
+    return result
+
+
+def get_batched_post_jsons(post_ids):
+    """Retrieve the JSON for post_ids in a single Algolia request.
+
+    Returns a dictionary of post ID to JSON in the same form as the
+    Firebase API.  Posts Algolia doesn't return are missing.
+    """
+    tags = ",".join("story_%d" % post_id for post_id in post_ids)
+    url = BATCH_POST_URL % (tags, len(post_ids))
+    result = get_json_from_url(url, max_age=POST_MAX_AGE)
+    if result is None or 'hits' not in result:
+        logger.error("No batch of posts retrieved.")
+        return {}
+
+    post_jsons = {}
+    for hit in result['hits']:
+        try:
+            post_json = {'id': int(hit['objectID']),
+                         'type': 'story',
+                         'title': hit['title'],
+                         'by': hit['author'],
+                         'score': hit['points'],
+                         'descendants': hit['num_comments']}
+        except (KeyError, ValueError):
+            logger.exception("Unexpected batch post %s", hit)
+            continue
+
+        # Leave incomplete posts to be retrieved individually.
+        if None in post_json.values():
+            continue
+
+        # Algolia gives text posts an empty or null 'url'.
+        if hit.get('url'):
+            post_json['url'] = hit['url']
+        post_jsons[post_json['id']] = post_json
+
+    logger.debug("Retrieved %d of %d posts in batch.",
+                 len(post_jsons), len(post_ids))
+    return post_jsons
 
 
 class Post():
     """Representation of a single news post."""
 
-    def __init__(self, id, rank):
-        logging.debug("Initialising post #%d with id %d" % (rank, id))
+    # Fixed attributes avoid a per-instance __dict__.
+    __slots__ = ('id', 'rank', 'title', 'author', 'points', 'comments', 'uri')
+
+    def __init__(self, id, rank, post_json):
         self.id = id
         self.rank = rank
         self.title = None
@@ -62,19 +228,22 @@ class Post():
         self.comments = None
         self.uri = None
 
-        # Use OrderedDict so we control order of elements in JSON output
-        self.dict = collections.OrderedDict()
-
-        # Retrieve additional information and build up
-        self.get_details()
+        # Populate from the already retrieved JSON
+        self.get_details(post_json)
 
     def __repr__(self):
         """Return post as JSON string."""
-        return json.dumps(self.as_dict(), indent=4, separators=(',', ': '))
+        return orjson.dumps(self.as_dict(),
+                            option=orjson.OPT_INDENT_2).decode()
+
+    def get_details(self, post_json):
+        """Populate object from the JSON for this post."""
+        if post_json is None:
+            # Retrieval failed.  Output the post with null fields.
+            logger.error("No JSON for post ID %s, rank %d",
+                         self.id, self.rank)
+            return
 
-    def get_details(self):
-        """Retrieve JSON for this post and populate object."""
-        post_json = self.get_post_json(self.id)
         try:
             # All expected post types have these properties.
             self.title = self.validate_string(post_json['title'])
@@ -98,70 +267,179 @@ class Post():
             # Missing JSON field.  Don't expect to hit this unless API changes.
             # We continue to execute with as much of the post as we processed
             # before the error.
-            logging.exception("KeyError whilst populating Post object ID %s, "
-                              "rank %d" % (self.id, self.rank))
-            logging.critical(post_json)
+            logger.exception("KeyError whilst populating Post object ID %s, "
+                             "rank %d", self.id, self.rank)
+            logger.critical(post_json)
 
     def validate_string(self, string):
         """Ensure string meets length requirements."""
-        logging.debug("Validating string %s" % string)
+        logger.debug("Validating string %s", string)
 
-        if len(string) > 256:
-            logging.warning("String too long. Truncating to 256 characters.")
+        # Return None in error case.  This is 'null' in final output.
+        if string is not None and not isinstance(string, str):
+            logger.error("Non-string provided to validate_string method.")
+            return None
+
+        # Check for empty first so None isn't passed to len().
+        if not string:
+            logger.error("String is empty.")
+        elif len(string) > 256:
+            logger.warning("String too long. Truncating to 256 characters.")
             string = string[:256]
-        elif string == "" or string is None:
-            logging.error("String is empty.")
         return string
 
     def validate_uri(self, uri):
         """Ensure URI is valid."""
-        logging.debug("Validating URL %s" % uri)
-
         # Return None in error case.  This is 'null' in final output.
+        # Check the type first as only strings can be looked up in the cache.
+        if not isinstance(uri, str):
+            logger.error("Non-string URL %s", uri)
+            return None
+        return self.validate_uri_string(uri)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=1024)
+    def validate_uri_string(uri):
+        """Ensure URI string is valid.  Results are cached by URI."""
+        logger.debug("Validating URL %s", uri)
+
+        # Only absolute http(s) URLs are accepted.
         try:
-            if not validators.url(uri):
-                uri = None
-        except validators.utils.ValidationFailure:
-            logging.error("Invalid URL %s" % uri)
+            parts = urlsplit(uri)
+        except ValueError:
+            parts = None
+
+        if (parts is None or parts.scheme not in ("http", "https") or
+                not parts.netloc):
+            logger.error("Invalid URL %s", uri)
             uri = None
         return uri
 
     def validate_int(self, integer):
         """Ensure value is non-negative integer."""
-        logging.debug("Validating Integer")
+        logger.debug("Validating Integer")
 
         # Return None in error case.  This is 'null' in final output.
         if not isinstance(integer, int):
-            logging.error("Non-integer provided to validate_int method.")
+            logger.error("Non-integer provided to validate_int method.")
             integer = None
         elif integer < 0:
-            logging.error("Integer is negative.")
+            logger.error("Integer is negative.")
             integer = None
         return integer
 
     def as_dict(self):
         """Return a representation of the post as a dictionary."""
-        post_dict = {}
-        post_dict['title'] = self.title
-        post_dict['uri'] = self.uri
-        post_dict['author'] = self.author
-        post_dict['points'] = self.points
-        post_dict['comments'] = self.comments
-        post_dict['rank'] = self.rank
-        return post_dict
+        # Dictionaries preserve insertion order, which sets the order of
+        # elements in the JSON output.
+        return {'title': self.title,
+                'uri': self.uri,
+                'author': self.author,
+                'points': self.points,
+                'comments': self.comments,
+                'rank': self.rank}
+
+
+class ItemLoader():
+    """Retrieve post JSON in batches shared between callers.
+
+    Posts requested within batch_interval_ms of each other are retrieved
+    together, and a post requested by several callers (for example
+    NewsReaders sharing this loader in a long running process) is only
+    retrieved once.  Safe to share between threads.
+    """
+
+    def __init__(self, batch=True, batch_interval_ms=5, max_batch_size=100):
+        # Whether to retrieve each batch in one request from Algolia, falling
+        # back to the Firebase API per post for any that are missing.
+        self.batch = batch
+        self.batch_interval = batch_interval_ms / 1000
+        self.max_batch_size = max_batch_size
+
+        # Futures by post ID for posts waiting for the next batch and for
+        # posts being retrieved.
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.in_flight = {}
+        self.timer = None
+        self.executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+
+    def load(self, post_id):
+        """Return a Future for the JSON of post_id."""
+        with self.lock:
+            future = self.pending.get(post_id) or self.in_flight.get(post_id)
+            if future is not None:
+                return future
+
+            future = Future()
+            self.pending[post_id] = future
+            if len(self.pending) >= self.max_batch_size:
+                self._flush()
+            elif self.timer is None:
+                self.timer = threading.Timer(self.batch_interval, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+        return future
+
+    def flush(self):
+        """Start retrieving all pending posts."""
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        """Start retrieving all pending posts.  Caller must hold the lock."""
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if not self.pending:
+            return
+
+        batch, self.pending = self.pending, {}
+        self.in_flight.update(batch)
+        self.executor.submit(self._load_batch, batch)
+
+    def _load_batch(self, batch):
+        """Retrieve a batch of posts, then any missing from it one by one."""
+        batched = {}
+        if self.batch:
+            try:
+                batched = get_batched_post_jsons(list(batch))
+            except Exception:
+                logger.exception("Error retrieving batch of posts")
+
+        for post_id, future in batch.items():
+            if post_id in batched:
+                self._resolve(post_id, future, batched[post_id])
+            else:
+                self.executor.submit(self._load_one, post_id, future)
 
-    def get_post_json(self, postId):
-        """Retrieve the JSON for this post ID."""
-        url = POST_URL % postId
-        return JSONHandler().get_json_from_url(url)
+    def _load_one(self, post_id, future):
+        """Retrieve a single post from the Firebase API."""
+        post_json = None
+        try:
+            post_json = get_json_from_url(POST_URL % post_id,
+                                          max_age=POST_MAX_AGE)
+        except Exception:
+            logger.exception("Error retrieving post ID %s", post_id)
+        self._resolve(post_id, future, post_json)
+
+    def _resolve(self, post_id, future, post_json):
+        """Hand post_json to everyone waiting on post_id."""
+        with self.lock:
+            del self.in_flight[post_id]
+        future.set_result(post_json)
 
 
 class NewsReader():
     """Main driver class.  Gathers posts and prints."""
 
-    def __init__(self):
+    def __init__(self, loader=None):
         self.post_ids = []
 
+        # Share a loader between readers to batch and deduplicate their
+        # requests.
+        self.loader = loader if loader is not None else ItemLoader()
+
     def read_news(self, num_posts):
         """Method to retrieve and print posts."""
         self.get_post_ids(num_posts)
@@ -169,11 +447,11 @@ class NewsReader():
 
     def get_post_ids(self, num_posts):
         """Retrieve num_posts post IDs from Hacker News."""
-        ids = JSONHandler().get_json_from_url(POST_LIST_URL)
+        ids = get_json_from_url(POST_LIST_URL, max_age=POST_LIST_MAX_AGE)
         if ids is None:
             # If we retrieved no IDs then can't continue.  Output the error and
             # exit.
-            logging.critical("No post list retrieved.")
+            logger.critical("No post list retrieved.")
             print("Error retrieving top posts from Hacker News.")
             sys.exit(1)
         else:
@@ -183,30 +461,55 @@ class NewsReader():
             # If we don't have enough we output the error but continue with
             # what we have.
             if num_retrieved < num_posts:
-                logging.error("Did not retrieve enough posts")
-                logging.error("ALERT: Only displaying %d posts" %
-                              num_retrieved)
+                logger.error("Did not retrieve enough posts")
+                logger.error("ALERT: Only displaying %d posts",
+                             num_retrieved)
 
-            logging.debug("Retrieved %d IDs.  Required %d." %
-                          (num_retrieved, num_posts))
+            logger.debug("Retrieved %d IDs.  Required %d.",
+                         num_retrieved, num_posts)
 
             # Store the number of post IDs that we require.
             self.post_ids = ids[:num_posts]
 
-    def get_and_print_news(self):
-        """Initialise post for each stored ID."""
-        output_list = []
-        for ii in range(len(self.post_ids)):
-            # Initialise post for ID at ii and get its dictionary
-            # representation.
-            new_post = Post(self.post_ids[ii], ii+1).as_dict()
-
-            # Add dictionary representation to output.
-            output_list.append(new_post)
+    def get_post_jsons(self):
+        """Yield the JSON for each stored ID, in rank order."""
+        # Retrieval is bound by network latency, so request every post up
+        # front and yield each in rank order as it becomes available.
+        futures = [self.loader.load(post_id) for post_id in self.post_ids]
+        for future in futures:
+            yield future.result()
 
-        # Pretty print the posts.  ensure_ascii and encoding maintain unicode
-        # characters in output.
-        print(json.dumps(output_list, indent=4, separators=(',', ': ')))
+    def get_and_print_news(self):
+        """Initialise post for each stored ID and print it."""
+        # Write each post as soon as it (and every post ranked above it) is
+        # retrieved, rather than building the whole list first.  The output
+        # is identical to dumping the list with OPT_INDENT_2.  orjson
+        # writes UTF-8, so unicode characters are output as-is.
+        # If an error stops the run part way, the array is still closed so
+        # the posts already written remain valid JSON.
+        out = sys.stdout.buffer
+        separator = b"[\n"
+        try:
+            post_jsons = self.get_post_jsons()
+            for rank, (post_id, post_json) in enumerate(zip(self.post_ids,
+                                                            post_jsons), 1):
+                # Initialise post and get its dictionary representation.
+                new_post = Post(post_id, rank, post_json).as_dict()
+
+                # Indent the post by one level to nest it in the list.  JSON
+                # strings can't contain raw newlines, so this is safe.
+                post_text = orjson.dumps(new_post, option=orjson.OPT_INDENT_2)
+                out.write(separator + b"  " +
+                          post_text.replace(b"\n", b"\n  "))
+                out.flush()
+                separator = b",\n"
+        finally:
+            if separator == b"[\n":
+                # No posts.
+                out.write(b"[]\n")
+            else:
+                out.write(b"\n]\n")
+            out.flush()
 
 
 class ArgParser():
@@ -219,6 +522,11 @@ class ArgParser():
 	                             type=int, required=True,
                                  help=('How many posts to print. '
                                        'A positive integer <= 100.'))
+        self.parser.add_argument('--firebase', dest='firebase',
+                                 action='store_true',
+                                 help=('Retrieve each post from the Hacker '
+                                       'News API rather than in one batch '
+                                       'from Algolia.'))
 
     def print_help(self):
         self.parser.print_help()
@@ -227,20 +535,65 @@ class ArgParser():
         """Retrieve and validate posts argument."""
         num_posts = self.parser.parse_args().posts
 
-        logging.debug("Number of posts requested is %d" % num_posts)
+        logger.debug("Number of posts requested is %d", num_posts)
 
         # Further validate the '--posts' argument.  Terminate on bad value.
         if num_posts <= 0 or num_posts > 100:
-            logging.critical("Invalid number of posts: %d. Terminating." %
-                             num_posts)
+            logger.critical("Invalid number of posts: %d. Terminating.",
+                            num_posts)
             self.print_help()
             sys.exit(2)
 
         return num_posts
 
+    def get_batch(self):
+        """Return whether posts should be retrieved in one batch."""
+        return not self.parser.parse_args().firebase
+
+
+def configure_logging():
+    """Set up logging for the command line tool.
+
+    Warnings and errors are always written to stderr.  If a level is set in
+    the LOG_LEVEL variable, by name or number, logs at that level are also
+    written to file.  A level of 0 logs everything.
+    """
+    stderr_handler = logging.StreamHandler()
+    stderr_handler.setLevel(logging.WARNING)
+    logger.addHandler(stderr_handler)
+    logger.setLevel(logging.WARNING)
+
+    log_level = os.environ.get('LOG_LEVEL')
+    if not log_level:
+        return
+
+    # getLevelName maps known names to their number.
+    if log_level.isdigit():
+        level = int(log_level)
+    else:
+        level = logging.getLevelName(log_level.upper())
+    if not isinstance(level, int):
+        logger.warning("Unknown LOG_LEVEL %s. Using WARNING.", log_level)
+        return
+
+    # NOTSET on the logger would defer to the root logger's WARNING.
+    level = max(level, logging.DEBUG)
+
+    # The level applies to the file only.  The logger must pass records
+    # for both handlers, so stderr still gets warnings and errors.
+    file_handler = logging.FileHandler('hackernews.log')
+    file_handler.setLevel(level)
+    file_handler.setFormatter(logging.Formatter(
+        fmt='%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s',
+        datefmt='%H:%M:%S'))
+    logger.addHandler(file_handler)
+    logger.setLevel(min(level, logging.WARNING))
+
 
 if __name__ == '__main__':
+    configure_logging()
     argparser = ArgParser()
     num_posts = argparser.get_num_posts()
 
-    NewsReader().read_news(num_posts)
+    loader = ItemLoader(batch=argparser.get_batch())
+    NewsReader(loader).read_news(num_posts)